@@ -1,19 +1,33 @@
 import os
+import re
 import json
+import time
 import pickle
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import uuid
+import unicodedata
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
-import ollama
-import psutil
+import gzip
+import argparse
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import socket
 import subprocess
-from tqdm import tqdm
+import threading
 import logging
 
+try:
+    import fcntl
+except ImportError:  # Windows: le scritture sono protette solo tra i thread dello stesso processo
+    fcntl = None
+
+# ollama, psutil, tqdm e le librerie Google vengono importati solo quando servono:
+# le esecuzioni senza email da categorizzare non pagano il loro tempo di caricamento
+
 # Configurazione del logging
 logging.basicConfig(
     filename='email_organizer.log',
@@ -24,15 +38,458 @@ logging.basicConfig(
 # Configurazione degli scope per l'API Gmail
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Caratteri del corpo scaricati per ogni email; il prompt è poi limitato da body_token_budget
+DEFAULT_BODY_EXTRACT_LENGTH = 4000
+
+# Troncamento a caratteri usato prima del preprocessing, riferimento per i token risparmiati
+LEGACY_BODY_LENGTH = 1000
+
+# Budget di token del corpo nel prompt: sotto i ~250 token stimati del vecchio troncamento su testo pulito
+DEFAULT_BODY_TOKEN_BUDGET = 160
+
+# Etichette di sistema di Gmail, ignorate quando si controlla se un'email è già organizzata
+SYSTEM_LABELS = ['INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'CATEGORY_PERSONAL',
+                 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES',
+                 'CATEGORY_FORUMS', 'STARRED', 'IMPORTANT', 'UNREAD']
+
+@lru_cache(maxsize=None)
+def _load_discovery_document(service_name='gmail', version='v1'):
+    """Carica (una sola volta per processo) il documento di discovery statico incluso in googleapiclient"""
+    from googleapiclient import discovery_cache
+    document = discovery_cache.get_static_doc(service_name, version)
+    return json.loads(document) if document else None
+
+# PooledHttp, iter_emails/export_snapshot e il backfill hanno una copia ridotta in No_IA/Email_NoIA.py
+# (le due versioni sono distribuite separatamente): ogni correzione va riportata anche lì.
+
+class PooledHttp:
+    """Trasporto HTTP thread-safe per googleapiclient, con pool di connessioni keep-alive.
+
+    Sostituisce httplib2 (non thread-safe, una connessione TLS per oggetto) con una
+    AuthorizedSession di requests condivisa tra i thread. Il refresh del token (scaduto
+    o rifiutato con 401) avviene una sola volta, sotto lock, e viene visto da tutti i thread.
+    """
+
+    def __init__(self, credentials, pool_size=10, timeout=60):
+        import requests
+        from google.auth.transport.requests import AuthorizedSession
+
+        self.credentials = credentials
+        self.timeout = timeout
+        self._refresh_lock = threading.Lock()
+        # Il refresh automatico su 401 di AuthorizedSession non ha lock: lo gestisce request()
+        self._session = AuthorizedSession(credentials, refresh_status_codes=())
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+
+    def _ensure_valid_credentials(self, rejected_token=None):
+        """Aggiorna il token scaduto (o rifiutato) una sola volta, anche con più thread in attesa"""
+        if self.credentials.valid and self.credentials.token != rejected_token:
+            return
+        with self._refresh_lock:
+            # Un altro thread può aver già aggiornato il token mentre si attendeva il lock
+            if not self.credentials.valid or self.credentials.token == rejected_token:
+                from google.auth.transport.requests import Request
+                self.credentials.refresh(Request())
+                logging.info("Token di accesso aggiornato")
+
+    def _send(self, method, uri, body, headers):
+        """Esegue la richiesta; googleapiclient ritenta solo socket.timeout e ConnectionError"""
+        import requests
+
+        try:
+            return self._session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise socket.timeout(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(str(e)) from e
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        """Interfaccia compatibile con httplib2.Http.request usata da googleapiclient"""
+        import httplib2
+
+        self._ensure_valid_credentials()
+        token = self.credentials.token
+        response = self._send(method, uri, body, headers)
+        if response.status_code == 401:
+            self._ensure_valid_credentials(rejected_token=token)
+            response = self._send(method, uri, body, headers)
+
+        # requests decomprime già il contenuto: le intestazioni di codifica non valgono più
+        info = {key.lower(): value for key, value in response.headers.items()
+                if key.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+    def close(self):
+        """Chiude le connessioni del pool"""
+        self._session.close()
+
+def build_gmail_service(credentials, pool_size=10):
+    """Crea il client Gmail dal documento di discovery statico, con trasporto thread-safe"""
+    from googleapiclient.discovery import build, build_from_document
+    http = PooledHttp(credentials, pool_size=pool_size)
+    document = _load_discovery_document()
+    if document is None:
+        return build('gmail', 'v1', http=http)
+    return build_from_document(document, http=http)
+
+# Nomi di categoria considerati equivalenti (forma normalizzata -> forma canonica)
+# Sinonimi applicati dopo la rimozione del plurale inglese: chiavi e valori sono al singolare
+CATEGORY_SYNONYMS = {
+    'acquisti': 'purchase',
+    'acquisto': 'purchase',
+    'ordini': 'purchase',
+    'ordine': 'purchase',
+    'order': 'purchase',
+    'sicurezza': 'security',
+    'viaggi': 'travel',
+    'viaggio': 'travel',
+    'gestione': 'management',
+    'amministrazione': 'management',
+    'lavoro': 'work',
+    'supporto': 'support',
+    'assistenza': 'support',
+    'intrattenimento': 'entertainment',
+    'salute': 'health',
+    'pubblicita': 'marketing',
+    'promozioni': 'marketing',
+    'promozione': 'marketing',
+    'promotion': 'marketing',
+    'altro': 'other',
+    'altri': 'other',
+}
+
+# Parole inglesi che finiscono in "s" ma non sono plurali: "News" non deve diventare "New"
+_NOT_PLURAL = {'news', 'series', 'species', 'analytics', 'logistics', 'economics', 'politics'}
+
+def normalize_category_name(name):
+    """Riduce un nome di categoria a una chiave confrontabile (maiuscole, accenti, plurali, sinonimi)"""
+    text = unicodedata.normalize('NFKD', name)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    # Si tengono le lettere di ogni alfabeto: "Новости" o "账单" non devono diventare una chiave vuota
+    key = re.sub(r'[\W_]+', ' ', text.casefold()).strip()
+    last_word = key.rsplit(' ', 1)[-1]
+    if (len(last_word) > 3 and last_word.endswith('s') and not last_word.endswith(('ss', 'us', 'is'))
+            and last_word not in _NOT_PLURAL):
+        key = key[:-1]
+    return CATEGORY_SYNONYMS.get(key, key)
+
+class CategoryStore:
+    """Archivio delle categorie con indice in memoria e persistenza append-only.
+
+    Ogni nuova categoria viene aggiunta come riga JSON a categories.log; il file
+    categories.json viene riscritto (file temporaneo + rename atomico) solo durante
+    la compattazione, al più ogni `compact_every` aggiunte o `compact_interval` secondi
+    e alla chiusura. Un lock su file rende sicure le scritture di più processi, che
+    prima di ogni aggiunta rileggono le righe scritte dagli altri.
+
+    Con `read_only=True` le categorie vengono lette ma nulla viene scritto su disco:
+    quelle aggiunte restano in memoria per la durata del processo.
+    """
+
+    def __init__(self, directory=None, seed_file=None, compact_every=50, compact_interval=30, read_only=False):
+        self.directory = directory or os.environ.get('CATEGORIES_DIR', os.path.dirname(os.path.abspath(__file__)))
+        self.snapshot_path = os.path.join(self.directory, 'categories.json')
+        self.log_path = os.path.join(self.directory, 'categories.log')
+        self.lock_path = os.path.join(self.directory, 'categories.lock')
+        self.seed_file = seed_file or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'categories.json')
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.read_only = read_only
+
+        self.categories = {}
+        self._index = {}
+        self._log_generation = None
+        self._log_offset = 0
+        self._pending = 0
+        self._last_compaction = time.monotonic()
+        self._lock = threading.RLock()
+
+        if read_only:
+            # Nessun lock: creerebbe categories.lock; una riga incompleta del log viene comunque ignorata
+            with self._lock:
+                self._reload()
+                self._replay_log()
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock():
+            self._reload()
+            self._replay_log()
+
+    @contextmanager
+    def _file_lock(self):
+        """Lock esclusivo tra thread e, dove disponibile, tra processi"""
+        with self._lock:
+            if not fcntl:
+                yield
+                return
+            with open(self.lock_path, 'a') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _index_category(self, name, info):
+        """Registra una categoria se non ne esiste già una equivalente"""
+        key = normalize_category_name(name)
+        if not key or key in self._index:
+            return False
+        self._index[key] = name
+        self.categories[name] = info
+        return True
+
+    def _read_snapshot(self):
+        """Legge categories.json; al primo avvio in una nuova directory parte da quello incluso nel progetto"""
+        for path in (self.snapshot_path, self.seed_file):
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        return json.load(f)
+            except Exception as e:
+                logging.error(f"Errore nel caricamento delle categorie da {path}: {e}")
+        return {}
+
+    def _reload(self):
+        """Ricostruisce l'indice dallo snapshot; il log va riletto da capo"""
+        self.categories = {}
+        self._index = {}
+        for name, info in self._read_snapshot().items():
+            if not self._index_category(name, info):
+                # Resta nello snapshot (la compattazione non la cancella) ma non viene proposta come nome canonico
+                canonical = self._index.get(normalize_category_name(name))
+                if canonical:
+                    logging.warning(f"Categoria '{name}' equivalente a '{canonical}' in categories.json: "
+                                    f"le email verranno etichettate come '{canonical}'")
+                else:
+                    logging.warning(f"Nome di categoria non valido in categories.json: '{name}'")
+                self.categories[name] = info
+        self._log_generation = None
+        self._log_offset = 0
+
+    def _start_log(self):
+        """Sostituisce il log con uno vuoto, identificato da una nuova generazione"""
+        generation = uuid.uuid4().hex
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.categories', suffix='.log')
+        with os.fdopen(fd, 'wb') as f:
+            header = (json.dumps({'generation': generation}) + '\n').encode('utf-8')
+            f.write(header)
+        os.replace(tmp_path, self.log_path)
+        self._log_generation = generation
+        self._log_offset = len(header)
+
+    def _replay_log(self):
+        """Applica le righe del log non ancora lette, comprese quelle scritte da altri processi"""
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            header = f.readline()
+            try:
+                generation = json.loads(header).get('generation')
+            except (ValueError, AttributeError):
+                generation = None
+            if generation is None:
+                logging.error(f"Intestazione non valida in {self.log_path}, log ignorato")
+                return
+            if generation != self._log_generation:
+                # Log nuovo o compattato da un altro processo: si riparte dallo snapshot
+                self._reload()
+                self._log_generation = generation
+                self._log_offset = len(header)
+
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # riga incompleta: verrà letta al prossimo giro
+                self._log_offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._index_category(entry['name'], entry['info'])
+
+    def copy(self):
+        """Copia delle categorie correnti: il dizionario interno cambia mentre altri thread aggiungono categorie"""
+        with self._lock:
+            return dict(self.categories)
+
+    def resolve(self, name):
+        """Restituisce il nome canonico di una categoria equivalente, o None"""
+        with self._lock:
+            return self._index.get(normalize_category_name(name))
+
+    def add(self, name, description=""):
+        """Aggiunge una categoria; restituisce (nome canonico, True se è stata creata)"""
+        if self.read_only:
+            with self._lock:
+                existing = self._index.get(normalize_category_name(name))
+                if existing:
+                    return existing, False
+                info = {"description": description, "created_at": datetime.now().isoformat()}
+                if not self._index_category(name, info):
+                    return None, False
+                return name, True
+
+        with self._file_lock():
+            self._replay_log()
+            existing = self._index.get(normalize_category_name(name))
+            if existing:
+                return existing, False
+
+            info = {
+                "description": description,
+                "created_at": datetime.now().isoformat()
+            }
+            if not self._index_category(name, info):
+                return None, False
+            try:
+                if self._log_generation is None:
+                    self._start_log()
+                with open(self.log_path, 'ab') as f:
+                    line = (json.dumps({'name': name, 'info': info}, ensure_ascii=False) + '\n').encode('utf-8')
+                    f.write(line)
+                self._log_offset += len(line)
+            except Exception as e:
+                logging.error(f"Errore nel salvataggio della categoria {name}: {e}")
+            self._pending += 1
+
+            if (self._pending >= self.compact_every
+                    or time.monotonic() - self._last_compaction >= self.compact_interval):
+                self._compact()
+            return name, True
+
+    def _compact(self):
+        """Riscrive categories.json in modo atomico e svuota il log (da chiamare con il lock)"""
+        try:
+            self._replay_log()
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.categories', suffix='.json')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.categories, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+
+            # Gli altri processi riconoscono il nuovo log dalla generazione diversa
+            self._start_log()
+            self._pending = 0
+            self._last_compaction = time.monotonic()
+        except Exception as e:
+            logging.error(f"Errore nella compattazione delle categorie: {e}")
+
+    def flush(self):
+        """Compatta le aggiunte in sospeso"""
+        if self.read_only:
+            return
+        with self._file_lock():
+            if self._pending:
+                self._compact()
+
+# Preprocessing del corpo: rimuove ciò che il modello dovrebbe leggere senza ricavarne nulla
+_QUOTE_HEADER_RE = re.compile(
+    r'^\s*(On .{1,200} wrote:|Il .{1,200} ha scritto:|-{2,}\s*(Original Message|Messaggio originale|Forwarded message|Messaggio inoltrato)\s*-{2,})\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
+_SIGNATURE_RE = re.compile(
+    r'^\s*(--\s*|Sent from my \w+.*|Inviato da(l mio)? \w+.*|Get Outlook for \w+.*)$',
+    re.IGNORECASE
+)
+# La firma si cerca solo in fondo: "Inviato da Amazon.it" a metà di un avviso di spedizione è contenuto
+_SIGNATURE_TAIL_LINES = 6
+_FOOTER_RE = re.compile(
+    r'unsubscribe|annulla (l\'|la )?iscrizione|cancella(ti)? (l\'|la )?iscrizione|privacy policy|informativa (sulla )?privacy'
+    r'|all rights reserved|tutti i diritti riservati|this (e-?mail|message) (is|was) (sent|intended|confidential)'
+    r'|questa (e-?mail|comunicazione) (è|e\') (stata inviata|riservata|destinata)|manage (your )?(email )?preferences'
+    r'|view (this email )?in (your )?browser|visualizza (nel|sul) browser',
+    re.IGNORECASE
+)
+# Oltre questa lunghezza una riga con un piè di pagina è un paragrafo (o l'intera email su una riga):
+# si taglia solo dalla frase che contiene il piè di pagina in poi
+_FOOTER_LINE_LENGTH = 120
+_SENTENCE_END_RE = re.compile(r'[.!?]\s')
+_URL_RE = re.compile(r'https?://([^/\s]+)\S*', re.IGNORECASE)
+_BASE64_RE = re.compile(r'[A-Za-z0-9+/=_-]{80,}')
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+def estimate_tokens(text):
+    """Stima veloce del numero di token: ogni parola lunga conta come più token, ogni simbolo come uno"""
+    return sum(1 + len(piece) // 6 for piece in _TOKEN_RE.findall(text))
+
+def truncate_to_tokens(text, token_budget):
+    """Tronca il testo al punto in cui la stima dei token raggiunge il budget"""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += 1 + len(match.group()) // 6
+        if used > token_budget:
+            return text[:match.start()].rstrip()
+    return text
+
+def _strip_footer(line):
+    """Rimuove da una riga il piè di pagina standard, se presente"""
+    match = _FOOTER_RE.search(line)
+    if not match:
+        return line
+    if len(line) <= _FOOTER_LINE_LENGTH:
+        return ''
+    sentence_start = 0
+    for end in _SENTENCE_END_RE.finditer(line, 0, match.start()):
+        sentence_start = end.end()
+    return line[:sentence_start].rstrip()
+
+def preprocess_body(body, token_budget=DEFAULT_BODY_TOKEN_BUDGET, max_url_length=40):
+    """Riduce il corpo dell'email al contenuto utile e lo tronca a un budget di token.
+
+    Rimuove la cronologia citata, la firma, i piè di pagina standard, i blob base64 e gli
+    URL lunghi (sostituiti dal dominio), poi comprime gli spazi.
+    """
+    if not body:
+        return ""
+    original = body
+
+    # La cronologia citata e la firma chiudono il messaggio: tutto ciò che segue si scarta
+    match = _QUOTE_HEADER_RE.search(body)
+    if match and match.start() > 0:
+        body = body[:match.start()]
+
+    raw_lines = body.rstrip().splitlines()
+    for i in range(max(1, len(raw_lines) - _SIGNATURE_TAIL_LINES), len(raw_lines)):
+        if _SIGNATURE_RE.match(raw_lines[i]):
+            raw_lines = raw_lines[:i]
+            break
+
+    lines = []
+    for line in raw_lines:
+        stripped = line.strip()
+        if stripped.startswith('>'):
+            continue
+        stripped = _strip_footer(stripped)
+        if stripped:
+            lines.append(stripped)
+    body = '\n'.join(lines)
+    if not body.strip():
+        # Meglio un corpo poco pulito che nessun corpo: il modello deciderebbe solo dall'oggetto
+        body = original
+
+    body = _URL_RE.sub(lambda m: m.group(0) if len(m.group(0)) <= max_url_length else f"[{m.group(1)}]", body)
+    body = _BASE64_RE.sub('', body)
+    body = re.sub(r'[ \t\u00a0]+', ' ', body)
+    body = re.sub(r'\n\s*\n+', '\n', body).strip()
+
+    return truncate_to_tokens(body, token_budget) if token_budget else body
+
 class AICategorizer:
-    def __init__(self):
-        self.categories_file = os.path.join(os.path.dirname(__file__), 'categories.json')
+    def __init__(self, check_resources=True, token_budget=DEFAULT_BODY_TOKEN_BUDGET, read_only=False):
+        import psutil
+
         ram = psutil.virtual_memory()
 
         self.model_name = "gemma3:12b"
+        # Diventa True solo a inizializzazione completata: se l'utente rinuncia il categorizzatore non è utilizzabile
+        self.ready = False
 
 
-        if ram.available < 9 * 1024**3:
+        if check_resources and ram.available < 9 * 1024**3:
             print(f"There isn't enough ram to use {self.model_name}")
             print(f"You got: {ram.available / 1024**3:.2f} GB of {ram.total / 1024**3:.2f} GB free and you'll need at least 8.3 GB free")
             rs = input("Did you wanna force the Email_IA.py run anyway? (y/n): ")
@@ -40,32 +497,21 @@ class AICategorizer:
                 return
             
             
-        self.categories = self._load_categories()
+        self.store = CategoryStore(read_only=read_only)
+        self.token_budget = token_budget
+        self.tokens_saved = 0
         self.max_iterations = 5
         self.tool_commands = {
             "GET_CATEGORIES": self.get_categories,
             "ADD_CATEGORY": self._add_category_tool,
             "GET_CATEGORY_INFO": self._get_category_info
         }
+        self.ready = True
 
-    def _load_categories(self):
-        """Carica le categorie dal file JSON"""
-        try:
-            if os.path.exists(self.categories_file):
-                with open(self.categories_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
-        except Exception as e:
-            logging.error(f"Errore nel caricamento delle categorie: {e}")
-            return {}
-
-    def _save_categories(self):
-        """Salva le categorie nel file JSON"""
-        try:
-            with open(self.categories_file, 'w', encoding='utf-8') as f:
-                json.dump(self.categories, f, indent=4)
-        except Exception as e:
-            logging.error(f"Errore nel salvataggio delle categorie: {e}")
+    @property
+    def categories(self):
+        """Copia delle categorie correnti, indicizzate per nome"""
+        return self.store.copy()
 
     def get_categories(self):
         """Restituisce tutte le categorie esistenti"""
@@ -73,14 +519,7 @@ class AICategorizer:
 
     def add_category(self, category_name, description=""):
         """Aggiunge una nuova categoria"""
-        if category_name not in self.categories:
-            self.categories[category_name] = {
-                "description": description,
-                "created_at": datetime.now().isoformat()
-            }
-            self._save_categories()
-            return True
-        return False
+        return self.store.add(category_name, description)[1]
 
     def _add_category_tool(self, *args):
         """Strumento per aggiungere una categoria"""
@@ -88,22 +527,28 @@ class AICategorizer:
             return "Errore: nome categoria mancante"
         category_name = args[0]
         description = args[1] if len(args) > 1 else ""
-        if self.add_category(category_name, description):
+        canonical_name, created = self.store.add(category_name, description)
+        if created:
             return f"Categoria '{category_name}' aggiunta con successo"
-        return f"La categoria '{category_name}' esiste già"
+        if canonical_name:
+            return f"La categoria '{canonical_name}' esiste già"
+        return "Errore: nome categoria non valido"
 
     def _get_category_info(self, *args):
         """Strumento per ottenere informazioni su una categoria"""
         if len(args) < 1:
             return "Errore: nome categoria mancante"
-        category_name = args[0]
-        if category_name in self.categories:
-            return self.categories[category_name]
-        return f"La categoria '{category_name}' non esiste"
+        category_name = self.store.resolve(args[0])
+        info = self.categories.get(category_name) if category_name else None
+        if info is not None:
+            return info
+        return f"La categoria '{args[0]}' non esiste"
 
     def _run_model(self, prompt):
         """Esegue il modello con il prompt fornito e gestisce la risposta"""
         try:
+            import ollama
+
             # Esegui il modello usando la libreria
             response = ollama.generate(
                 model=self.model_name,
@@ -126,8 +571,24 @@ class AICategorizer:
             logging.error(f"Errore nell'esecuzione del modello: {e}")
             return None
 
+    def _prepare_email(self, email_data):
+        """Applica il preprocessing al corpo e registra i token risparmiati rispetto al vecchio troncamento"""
+        if not self.token_budget:
+            return email_data
+        body = email_data.get('body', '')
+        downloaded = estimate_tokens(body)
+        legacy = estimate_tokens(body[:LEGACY_BODY_LENGTH])
+        # Il prompt non supera mai quello del vecchio troncamento, anche con un budget configurato più alto
+        compact_body = preprocess_body(body, max(1, min(self.token_budget, legacy)))
+        after = estimate_tokens(compact_body)
+        self.tokens_saved += legacy - after
+        logging.info(f"Email {email_data.get('id')}: {after} token stimati dopo il preprocessing, "
+                     f"{legacy} con il troncamento a {LEGACY_BODY_LENGTH} caratteri ({downloaded} scaricati)")
+        return dict(email_data, body=compact_body)
+
     def categorize_email(self, email_data):
         """Categorizza un'email usando il modello in un loop interattivo"""
+        email_data = self._prepare_email(email_data)
         conversation_history = []
         current_iteration = 0
         last_tool_result = None
@@ -157,9 +618,8 @@ class AICategorizer:
                 # Verifica se è una categoria valida
                 category = self._parse_model_response(response)
                 if category:
-                    if category not in self.categories:
-                        self.add_category(category)
-                    return category
+                    # Riusa la categoria equivalente già esistente, o creala
+                    return self.store.add(category)[0] or category
                 else:
                     # Se non è una categoria valida, informa il modello
                     conversation_history.append({
@@ -321,6 +781,9 @@ REMEMBER:
 
     def close(self):
         """Chiude la connessione con il modello"""
+        if not self.ready:
+            return
+        self.store.flush()
         try:
             # Ferma il modello usando il comando da terminale
             subprocess.run(['ollama', 'stop', self.model_name], check=True)
@@ -336,6 +799,9 @@ class GmailAuthenticator:
 
     def get_credentials(self):
         """Gestisce l'autenticazione e restituisce le credenziali Gmail"""
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         creds = None
         
         # Controlla se esiste un token salvato
@@ -387,27 +853,183 @@ class ConfigManager:
             "settings": {
                 "max_emails_to_process": 50,
                 "check_body": True,
-                "body_extract_length": 1000
+                "body_extract_length": DEFAULT_BODY_EXTRACT_LENGTH,
+                "body_token_budget": DEFAULT_BODY_TOKEN_BUDGET,
+                "http_pool_size": 10,
+                "quota_units_per_second": 200,
+                "cascade": False,
+                "cascade_min_keywords": 2
             }
         }
 
-class GmailService:
+def rules_from_categories(categories):
+    """Ricava regole a parole chiave da categories.json, solo dalle categorie con un campo 'keywords' esplicito"""
+    rules = {}
+    for name, info in categories.items():
+        if normalize_category_name(name) == 'other':
+            continue  # "Other" è il ripiego del modello, non una categoria da riconoscere
+        if info.get('keywords'):
+            rules[name] = info['keywords']
+    return rules
+
+def map_rules_to_categories(rules, store, category_map=None):
+    """Riporta le categorie delle regole sui nomi di categories.json, così regole e modello usano le stesse etichette.
+
+    Ogni categoria viene cercata prima in `category_map` (nome della regola -> categoria) e poi tra le
+    categorie equivalenti dell'archivio; quelle senza corrispondenza vengono ignorate.
+    """
+    category_map = category_map or {}
+    mapped = {}
+    for name, keywords in rules.items():
+        target = store.resolve(category_map.get(name, name))
+        if not target:
+            logging.warning(f"Regole '{name}' ignorate: nessuna categoria corrispondente, aggiungila a cascade_category_map")
+            continue
+        mapped.setdefault(target, []).extend(keywords)
+    return mapped
+
+class RuleEngine:
+    """Primo passaggio a parole chiave prima del modello.
+
+    Accetta solo le email in cui compaiono almeno `min_keywords` parole chiave distinte di una
+    sola categoria; le email senza corrispondenze o con più categorie in conflitto vanno al modello.
+    """
+
+    def __init__(self, rules, min_keywords=2):
+        # Una sola parola chiave non basta mai per saltare il modello
+        self.min_keywords = max(2, min_keywords)
+        self._patterns = []
+        for category, keywords in rules.items():
+            words = sorted({keyword.lower().strip() for keyword in keywords if keyword.strip()}, key=len, reverse=True)
+            if words:
+                pattern = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(word) for word in words) + r')(?!\w)')
+                self._patterns.append((category, pattern))
+
+    def match(self, email_data):
+        """Restituisce (categoria, None) se la corrispondenza è sicura, altrimenti (None, motivo)"""
+        content = " ".join(email_data.get(field, '') for field in ('subject', 'sender', 'body')).lower()
+        hits = {}
+        for category, pattern in self._patterns:
+            found = set(pattern.findall(content))
+            if found:
+                hits[category] = len(found)
+        if not hits:
+            return None, 'nessuna regola'
+        if len(hits) > 1:
+            return None, 'conflitto'
+        category, count = next(iter(hits.items()))
+        if count < self.min_keywords:
+            return None, 'punteggio basso'
+        return category, None
+
+def build_rule_engine(config):
+    """Crea il motore di regole del primo passaggio, o None se la modalità a cascata è disattivata.
+
+    Le regole vengono, in ordine, dal file indicato da settings.cascade_rules_path (ad esempio
+    il config.json della versione senza IA), dalla sezione "rules" della configurazione o dai
+    campi "keywords" di categories.json. Le categorie delle regole vengono sempre riportate su
+    quelle di categories.json.
+    """
+    settings = config.get("settings", {})
+    if not settings.get("cascade", False):
+        return None
+
+    rules = {}
+    rules_path = settings.get("cascade_rules_path")
+    if rules_path:
+        try:
+            with open(rules_path, 'r', encoding='utf-8') as f:
+                rules = json.load(f).get("rules", {})
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Errore nel caricamento delle regole da {rules_path}: {e}")
+    if not rules:
+        rules = config.get("rules", {})
+
+    store = CategoryStore()
+    if rules:
+        rules = map_rules_to_categories(rules, store, settings.get("cascade_category_map"))
+    else:
+        rules = rules_from_categories(store.copy())
+
+    if not rules:
+        logging.warning("Modalità a cascata attiva ma senza regole utilizzabili: tutte le email vanno al modello")
+        return None
+    logging.info(f"Modalità a cascata attiva con {len(rules)} categorie di regole")
+    return RuleEngine(rules, min_keywords=settings.get("cascade_min_keywords", 2))
+
+class CascadeStats:
+    """Conteggi e tempi per livello della cascata (regole / modello)"""
+
     def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+        self._lock = threading.Lock()
+
+    def record(self, tier, seconds):
+        with self._lock:
+            self.counts[tier] = self.counts.get(tier, 0) + 1
+            self.seconds[tier] = self.seconds.get(tier, 0) + seconds
+
+    def report(self):
+        """Scrive nel log la percentuale di email per livello e il tempo risparmiato stimato"""
+        total = sum(self.counts.values())
+        if not total:
+            return
+        for tier, count in sorted(self.counts.items()):
+            logging.info(f"Cascata - {tier}: {count}/{total} ({count / total * 100:.1f}%), "
+                         f"{self.seconds[tier] / count * 1000:.1f} ms in media")
+        rule_hits = self.counts.get('regole', 0)
+        llm_calls = total - rule_hits
+        if rule_hits and llm_calls:
+            llm_seconds = sum(seconds for tier, seconds in self.seconds.items() if tier != 'regole')
+            saved = rule_hits * llm_seconds / llm_calls - self.seconds['regole']
+            logging.info(f"Cascata - tempo del modello risparmiato stimato: {saved:.1f} s")
+
+class GmailService:
+    def __init__(self, pool_size=10, token_budget=DEFAULT_BODY_TOKEN_BUDGET, rule_engine=None):
         self.authenticator = GmailAuthenticator()
+        self.pool_size = pool_size
+        self.token_budget = token_budget
+        self.rule_engine = rule_engine
+        self.cascade_stats = CascadeStats()
         self.service = None
-        self.categorizer = AICategorizer()
+        self._categorizer = None
+        self._label_ids = None
+        self._label_lock = threading.Lock()
+
+    @property
+    def categorizer(self):
+        """Crea il categorizzatore (e verifica le risorse) solo alla prima email da categorizzare"""
+        if self._categorizer is None:
+            self._categorizer = AICategorizer(token_budget=self.token_budget)
+        return self._categorizer
 
     def get_service(self):
         """Crea e restituisce il servizio Gmail autenticato"""
         if not self.service:
             creds = self.authenticator.get_credentials()
-            self.service = build('gmail', 'v1', credentials=creds)
+            self.service = build_gmail_service(creds, pool_size=self.pool_size)
         return self.service
 
+    def categorize(self, email_data):
+        """Categorizza un'email: prima con le regole (se attive), poi con il modello"""
+        reason = 'modello'
+        if self.rule_engine:
+            start = time.perf_counter()
+            category, reason = self.rule_engine.match(email_data)
+            if category:
+                self.cascade_stats.record('regole', time.perf_counter() - start)
+                return category
+
+        start = time.perf_counter()
+        category = self.categorizer.categorize_email(email_data)
+        self.cascade_stats.record(f"modello ({reason})" if self.rule_engine else reason, time.perf_counter() - start)
+        return category
+
     def process_email(self, email_data):
         """Processa un'email e la categorizza"""
-        # Ottieni la categoria usando il modello
-        category = self.categorizer.categorize_email(email_data)
+        # Ottieni la categoria con le regole o con il modello
+        category = self.categorize(email_data)
         
         if category:
             # Applica l'etichetta all'email
@@ -415,27 +1037,24 @@ class GmailService:
             return category
         return None
 
-    def _apply_label(self, email_id, category):
-        """Applica un'etichetta a un'email"""
-        try:
-            # Ottieni tutte le etichette esistenti
-            labels_response = self.service.users().labels().list(userId='me').execute()
-            labels = labels_response.get('labels', [])
-            
-            # Cerca l'ID dell'etichetta
-            label_id = None
-            for label_obj in labels:
-                if label_obj['name'] == category:
-                    label_id = label_obj['id']
-                    break
-            
-            # Crea l'etichetta se non esiste
-            if not label_id:
+    def _get_label_id(self, category):
+        """Restituisce l'id dell'etichetta, creandola se non esiste (elenco letto una volta e condiviso tra i thread)"""
+        with self._label_lock:
+            if self._label_ids is None:
+                labels_response = self.service.users().labels().list(userId='me').execute()
+                self._label_ids = {label['name']: label['id'] for label in labels_response.get('labels', [])}
+            if category not in self._label_ids:
                 created_label = self.service.users().labels().create(
                     userId='me',
                     body={'name': category}
                 ).execute()
-                label_id = created_label['id']
+                self._label_ids[category] = created_label['id']
+            return self._label_ids[category]
+
+    def _apply_label(self, email_id, category):
+        """Applica un'etichetta a un'email"""
+        try:
+            label_id = self._get_label_id(category)
 
             # Applica l'etichetta all'email
             self.service.users().messages().modify(
@@ -449,7 +1068,36 @@ class GmailService:
             logging.error(f"Errore nell'applicazione dell'etichetta: {e}")
             return False
 
-def get_emails(service, max_results=50, include_body=True, body_length=1000):
+def parse_message(msg, include_body=True, body_length=DEFAULT_BODY_EXTRACT_LENGTH):
+    """Estrae id, intestazioni e corpo da un messaggio Gmail"""
+    headers = msg['payload']['headers']
+    subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'Nessun oggetto')
+    sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Mittente sconosciuto')
+    date_str = next((header['value'] for header in headers if header['name'] == 'Date'), '')
+    
+    # Estrai il corpo dell'email
+    body = ""
+    if include_body:
+        if 'parts' in msg['payload']:
+            for part in msg['payload']['parts']:
+                if part['mimeType'] == 'text/plain' and 'data' in part['body']:
+                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
+                    break
+        elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
+            body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8', errors='ignore')
+        
+        # Limita la lunghezza del corpo
+        body = body[:body_length] if body else ""
+    
+    return {
+        'id': msg['id'],
+        'subject': subject,
+        'sender': sender,
+        'date': date_str,
+        'body': body
+    }
+
+def get_emails(service, max_results=50, include_body=True, body_length=DEFAULT_BODY_EXTRACT_LENGTH):
     """Ottiene le email dalla casella di posta"""
     try:
         # Ottieni la lista delle email
@@ -471,69 +1119,163 @@ def get_emails(service, max_results=50, include_body=True, body_length=1000):
             # Controlla se l'email ha già delle etichette
             if 'labelIds' in msg and len(msg['labelIds']) > 0:
                 # Ignora le etichette di sistema di Gmail
-                system_labels = ['INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'CATEGORY_PERSONAL', 
-                               'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 
-                               'CATEGORY_FORUMS', 'STARRED', 'IMPORTANT', 'UNREAD']
-                custom_labels = [label for label in msg['labelIds'] if label not in system_labels]
+                custom_labels = [label for label in msg['labelIds'] if label not in SYSTEM_LABELS]
                 
                 if custom_labels:
                     logging.info(f"Email {message['id']} già etichettata, ignorata")
                     continue
 
-            headers = msg['payload']['headers']
-            subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'Nessun oggetto')
-            sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Mittente sconosciuto')
-            date_str = next((header['value'] for header in headers if header['name'] == 'Date'), '')
-            
-            # Estrai il corpo dell'email
-            body = ""
-            if include_body:
-                if 'parts' in msg['payload']:
-                    for part in msg['payload']['parts']:
-                        if part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                            body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-                            break
-                elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                    body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8', errors='ignore')
-                
-                # Limita la lunghezza del corpo
-                body = body[:body_length] if body else ""
-            
-            emails.append({
-                'id': message['id'],
-                'subject': subject,
-                'sender': sender,
-                'date': date_str,
-                'body': body
-            })
+            emails.append(parse_message(msg, include_body, body_length))
         
         return emails
     except Exception as e:
         logging.error(f"Errore nel recupero delle email: {e}")
         return []
 
-def process_emails(service, emails, config):
-    """Processa le email e le categorizza"""
+def iter_emails(service, max_results=None, include_body=True, body_length=DEFAULT_BODY_EXTRACT_LENGTH, query=None, limiter=None):
+    """Scorre tutte le pagine della casella di posta restituendo un'email alla volta.
+
+    Gli errori temporanei (429, 5xx, rete) vengono ritentati; le email eliminate tra
+    list e get vengono saltate.
+    """
+    from googleapiclient.errors import HttpError
+
+    page_token = None
+    fetched = 0
+    while True:
+        page_size = 500 if max_results is None else min(500, max_results - fetched)
+        if page_size <= 0:
+            return
+        if limiter:
+            limiter.acquire(QUOTA_COST['messages.list'])
+        results = service.users().messages().list(
+            userId='me', maxResults=page_size, pageToken=page_token, q=query
+        ).execute(num_retries=5)
+        for message in results.get('messages', []):
+            if limiter:
+                limiter.acquire(QUOTA_COST['messages.get'])
+            try:
+                msg = service.users().messages().get(userId='me', id=message['id']).execute(num_retries=5)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logging.warning(f"Email {message['id']} non più disponibile, saltata")
+                continue
+            fetched += 1
+            yield parse_message(msg, include_body, body_length)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def _open_snapshot(path, mode):
+    """Apre un file snapshot, compresso con gzip se termina in .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def export_snapshot(emails, path):
+    """Scrive le email in uno snapshot JSONL (una email per riga) e restituisce il numero di righe.
+
+    Lo snapshot viene scritto in un file temporaneo e rinominato solo a fine esportazione:
+    un errore a metà non sovrascrive lo snapshot precedente.
+    """
+    count = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.snapshot',
+                                    suffix='.jsonl.gz' if path.endswith('.gz') else '.jsonl')
+    os.close(fd)
+    try:
+        with _open_snapshot(tmp_path, 'w') as f:
+            for email in emails:
+                f.write(json.dumps(email, ensure_ascii=False) + '\n')
+                count += 1
+                if count % 1000 == 0:
+                    logging.info(f"Esportate {count} email...")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return count
+
+def read_snapshot(path):
+    """Legge uno snapshot JSONL restituendo un'email alla volta"""
+    with _open_snapshot(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# Categorizzatore del singolo processo del pool di classificazione offline
+_worker_categorizer = None
+
+def _init_classify_worker(token_budget):
+    """Inizializza un categorizzatore per processo; il controllo della RAM è fatto dal processo principale.
+
+    L'archivio delle categorie è in sola lettura: la classificazione offline non deve
+    modificare le categorie usate dall'etichettatura reale.
+    """
+    global _worker_categorizer
+    _worker_categorizer = AICategorizer(check_resources=False, token_budget=token_budget, read_only=True)
+
+def _classify_worker(email):
+    """Categorizza un'email dello snapshot"""
+    return email, _worker_categorizer.categorize_email(email) or "Other"
+
+def classify_snapshot(snapshot_path, output_path, baseline=None, workers=1, token_budget=DEFAULT_BODY_TOKEN_BUDGET):
+    """Categorizza offline uno snapshot e restituisce le differenze rispetto a una classificazione precedente"""
+    total = 0
+    changes = {}
+    from tqdm import tqdm
+
+    baseline = baseline or {}
+    with Pool(processes=workers, initializer=_init_classify_worker, initargs=(token_budget,)) as pool, \
+            _open_snapshot(output_path, 'w') as out:
+        results = pool.imap_unordered(_classify_worker, read_snapshot(snapshot_path))
+        with tqdm(desc="Classificazione offline", unit="email") as pbar:
+            for email, category in results:
+                total += 1
+                before = baseline.get(email['id'], {}).get('category')
+                out.write(json.dumps({
+                    'id': email['id'],
+                    'subject': email['subject'],
+                    'sender': email['sender'],
+                    'category': category,
+                    'before': before
+                }, ensure_ascii=False) + '\n')
+                if email['id'] in baseline and before != category:
+                    changes[(before, category)] = changes.get((before, category), 0) + 1
+                pbar.set_postfix({"Categoria": category})
+                pbar.update(1)
+    return total, changes
+
+def process_emails(service, emails, config, gmail_service=None):
+    """Processa le email e le categorizza; restituisce False se il modello non è disponibile"""
+    from tqdm import tqdm
+
     if not emails:
         logging.info("Nessuna email da processare.")
-        return
+        return True
 
     logging.info(f"Inizio elaborazione di {len(emails)} email...")
     categorized_count = 0
     skipped_count = 0
-    gmail_service = GmailService()
+    if gmail_service is None:
+        gmail_service = GmailService()
     gmail_service.service = service
 
+    # Il controllo della RAM (che può chiedere conferma all'utente) va fatto prima della barra di avanzamento,
+    # e solo se almeno un'email non viene etichettata dalle regole
+    rule_engine = gmail_service.rule_engine
+    needs_model = not rule_engine or any(rule_engine.match(email)[0] is None for email in emails)
+    if needs_model and not gmail_service.categorizer.ready:
+        logging.info("Modello non avviato: nessuna email elaborata.")
+        return False
+
     # Crea la barra di caricamento
     with tqdm(total=len(emails), desc="Elaborazione email", unit="email") as pbar:
         for email in emails:
             # Verifica se l'email ha già delle etichette personalizzate
             msg = service.users().messages().get(userId='me', id=email['id']).execute()
             if 'labelIds' in msg:
-                system_labels = ['INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'CATEGORY_PERSONAL', 
-                               'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 
-                               'CATEGORY_FORUMS', 'STARRED', 'IMPORTANT', 'UNREAD']
-                custom_labels = [label for label in msg['labelIds'] if label not in system_labels]
+                custom_labels = [label for label in msg['labelIds'] if label not in SYSTEM_LABELS]
                 
                 if custom_labels:
                     pbar.set_postfix({"Stato": "Saltata", "Etichette": ', '.join(custom_labels)})
@@ -559,9 +1301,322 @@ def process_emails(service, emails, config):
     logging.info(f"Email categorizzate: {categorized_count}/{len(emails)}")
     logging.info(f"Email saltate (già etichettate): {skipped_count}")
     logging.info(f"Percentuale di successo: {(categorized_count/(len(emails)-skipped_count)*100):.1f}%")
+    if gmail_service._categorizer:
+        logging.info(f"Token stimati risparmiati dal preprocessing rispetto al troncamento a "
+                     f"{LEGACY_BODY_LENGTH} caratteri: {gmail_service._categorizer.tokens_saved}")
+    gmail_service.cascade_stats.report()
+    return True
+
+def run_export(args):
+    """Esporta la casella di posta in uno snapshot locale"""
+    settings = ConfigManager().load_config().get("settings", {})
+    service = build_gmail_service(
+        GmailAuthenticator().get_credentials(),
+        pool_size=settings.get("http_pool_size", 10)
+    )
+    emails = iter_emails(
+        service,
+        max_results=args.max_emails,
+        include_body=settings.get("check_body", True),
+        body_length=settings.get("body_extract_length", DEFAULT_BODY_EXTRACT_LENGTH),
+        query=args.query,
+        limiter=QuotaLimiter(settings.get("quota_units_per_second", 200))
+    )
+    count = export_snapshot(emails, args.snapshot)
+    print(f"Snapshot completato: {count} email salvate in {args.snapshot}")
+    return 0
+
+def run_classify(args):
+    """Categorizza offline uno snapshot senza chiamate a Gmail"""
+    # Controllo delle risorse una sola volta, prima di avviare i processi del pool
+    if not AICategorizer(read_only=True).ready:
+        return 1
+
+    baseline = {}
+    if args.baseline:
+        baseline = {record['id']: record for record in read_snapshot(args.baseline)}
+
+    settings = ConfigManager().load_config().get("settings", {})
+    total, changes = classify_snapshot(
+        args.snapshot, args.output, baseline, args.workers,
+        token_budget=settings.get("body_token_budget", DEFAULT_BODY_TOKEN_BUDGET)
+    )
+
+    print("\n--- Risultati della classificazione offline ---")
+    print(f"Email analizzate: {total}")
+    if args.baseline:
+        print(f"Email con categoria diversa da {args.baseline}: {sum(changes.values())}")
+        for (before, after), count in sorted(changes.items(), key=lambda item: -item[1]):
+            print(f"  {before} -> {after}: {count}")
+    print(f"Risultati salvati in {args.output}")
+    return 0
+
+# Backfill (copia ridotta in No_IA/Email_NoIA.py)
+# Costo in unità di quota Gmail dei metodi usati dal backfill (limite: 250 unità per utente al secondo)
+QUOTA_COST = {'messages.list': 5, 'messages.get': 5, 'messages.modify': 5}
+
+class QuotaLimiter:
+    """Token bucket thread-safe sulle unità di quota Gmail al secondo"""
+
+    def __init__(self, units_per_second=200):
+        self.units_per_second = units_per_second
+        self._available = units_per_second
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        """Attende finché non ci sono abbastanza unità di quota disponibili"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available = min(self.units_per_second,
+                                      self._available + (now - self._last) * self.units_per_second)
+                self._last = now
+                if self._available >= units:
+                    self._available -= units
+                    return
+                wait = (units - self._available) / self.units_per_second
+            time.sleep(wait)
+
+def make_shards(since, until, shard_days=30):
+    """Divide l'intervallo [since, until) in shard di date, dal più recente al più vecchio"""
+    shards = []
+    end = until
+    while end > since:
+        start = max(since, end - timedelta(days=shard_days))
+        shards.append({
+            'after': int(start.timestamp()),
+            'before': int(end.timestamp()),
+            'page_token': None,
+            'last_message': None,
+            'processed': 0,
+            'labeled': 0,
+            'failed': 0,
+            'failed_messages': [],
+            'estimate': None,
+            'done': False
+        })
+        end = start
+    return shards
+
+class BackfillCheckpoint:
+    """Avanzamento del backfill su disco: per ogni shard page token, ultimo messaggio e conteggi"""
+
+    def __init__(self, path, shards):
+        self.path = path
+        self.shards = shards
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, path):
+        """Carica un checkpoint esistente, o None se non c'è"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(path, json.load(f)['shards'])
+
+    def update(self, index, force=False, **fields):
+        """Aggiorna lo stato di uno shard; su disco al più una volta al secondo, salvo force"""
+        with self._lock:
+            self.shards[index].update(fields)
+            if force or time.monotonic() - self._last_save >= 1:
+                self._save()
+
+    def _save(self):
+        """Scrive il checkpoint in modo atomico (file temporaneo + rename)"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.backfill', suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'shards': self.shards, 'updated_at': datetime.now().isoformat()}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+def _shard_name(shard):
+    after = datetime.fromtimestamp(shard['after']).strftime('%Y-%m-%d')
+    before = datetime.fromtimestamp(shard['before']).strftime('%Y-%m-%d')
+    return f"{after} → {before}"
+
+def _format_eta(seconds):
+    return str(timedelta(seconds=int(seconds))) if seconds is not None else '?'
+
+def _report_shard(shard, processed_now, started):
+    """Stampa avanzamento, velocità e tempo stimato rimanente di uno shard"""
+    elapsed = time.monotonic() - started
+    rate = processed_now / elapsed if elapsed > 0 else 0
+    estimate = shard['estimate'] or 0
+    remaining = max(estimate - shard['processed'], 0)
+    eta = remaining / rate if rate else None
+    state = "completato" if shard['done'] else f"ETA {_format_eta(eta)}"
+    print(f"[{_shard_name(shard)}] {shard['processed']}/~{estimate} email, "
+          f"{shard['labeled']} etichettate, {shard.get('failed', 0)} con errori, {rate:.1f} email/s, {state}")
+
+def backfill_shard(service, checkpoint, index, limiter, handle_message, stop_event):
+    """Elabora tutte le email di uno shard riprendendo dal checkpoint"""
+    shard = checkpoint.shards[index]
+    if shard['done'] or stop_event.is_set():
+        return
+    query = f"after:{shard['after']} before:{shard['before']}"
+    page_token = shard['page_token']
+    skip_until = shard['last_message']
+    started = time.monotonic()
+    processed_now = 0
+
+    while True:
+        limiter.acquire(QUOTA_COST['messages.list'])
+        results = service.users().messages().list(
+            userId='me', q=query, maxResults=500, pageToken=page_token
+        ).execute(num_retries=5)
+        if shard['estimate'] is None:
+            checkpoint.update(index, estimate=results.get('resultSizeEstimate', 0))
+
+        messages = results.get('messages', [])
+        # Ripresa a metà pagina: salta i messaggi già elaborati
+        ids = [message['id'] for message in messages]
+        if skip_until in ids:
+            messages = messages[ids.index(skip_until) + 1:]
+        skip_until = None
+
+        for message in messages:
+            if stop_event.is_set():
+                return
+            fields = {'last_message': message['id'], 'processed': shard['processed'] + 1}
+            try:
+                limiter.acquire(QUOTA_COST['messages.get'])
+                msg = service.users().messages().get(userId='me', id=message['id']).execute(num_retries=5)
+                fields['labeled'] = shard['labeled'] + (1 if handle_message(msg) else 0)
+            except Exception as e:
+                # Un singolo messaggio (ad esempio eliminato nel frattempo) non deve fermare il backfill
+                logging.error(f"Errore nell'elaborazione dell'email {message['id']}: {e}")
+                fields['failed'] = shard.get('failed', 0) + 1
+                fields['failed_messages'] = shard.get('failed_messages', []) + [message['id']]
+            processed_now += 1
+            checkpoint.update(index, **fields)
+            if processed_now % 200 == 0:
+                _report_shard(shard, processed_now, started)
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+        checkpoint.update(index, force=True, page_token=page_token, last_message=None)
+
+    checkpoint.update(index, force=True, done=True, page_token=None, last_message=None)
+    _report_shard(shard, processed_now, started)
+
+def run_backfill(args):
+    """Organizza l'intera casella di posta per intervalli di date, con ripresa da checkpoint"""
+    config = ConfigManager().load_config()
+    settings = config.get("settings", {})
+
+    checkpoint = None if args.restart else BackfillCheckpoint.load(args.checkpoint)
+    if checkpoint:
+        print(f"Ripresa del backfill da {args.checkpoint}")
+    else:
+        since = datetime.strptime(args.since, '%Y-%m-%d')
+        until = datetime.strptime(args.until, '%Y-%m-%d') if args.until else datetime.now() + timedelta(days=1)
+        checkpoint = BackfillCheckpoint(args.checkpoint, make_shards(since, until, args.shard_days))
+        checkpoint.save()
+
+    pending = [i for i, shard in enumerate(checkpoint.shards) if not shard['done']]
+    print(f"Shard da elaborare: {len(pending)}/{len(checkpoint.shards)}")
+
+    gmail_service = GmailService(
+        pool_size=max(settings.get("http_pool_size", 10), args.workers),
+        token_budget=settings.get("body_token_budget", DEFAULT_BODY_TOKEN_BUDGET),
+        rule_engine=build_rule_engine(config)
+    )
+    service = gmail_service.get_service()
+
+    # Il categorizzatore (con il controllo della RAM) va creato prima di avviare i thread
+    if pending and not gmail_service.categorizer.ready:
+        return 1
+    limiter = QuotaLimiter(settings.get("quota_units_per_second", 200))
+    include_body = settings.get("check_body", True)
+    body_length = settings.get("body_extract_length", DEFAULT_BODY_EXTRACT_LENGTH)
+
+    def handle_message(msg):
+        # Le email già organizzate restano come sono
+        if any(label not in SYSTEM_LABELS for label in msg.get('labelIds', [])):
+            return None
+        email = parse_message(msg, include_body, body_length)
+        category = gmail_service.categorize(email) or "Other"
+        limiter.acquire(QUOTA_COST['messages.modify'])
+        if not gmail_service._apply_label(msg['id'], category):
+            raise RuntimeError(f"etichetta '{category}' non applicata")
+        return category
+
+    started = time.monotonic()
+    stop_event = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(backfill_shard, service, checkpoint, i, limiter, handle_message, stop_event)
+                       for i in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Interruzione (anche Ctrl+C): i thread si fermano al messaggio corrente
+                stop_event.set()
+                raise
+    finally:
+        checkpoint.save()
+        if gmail_service._categorizer:
+            gmail_service._categorizer.close()
+
+    processed = sum(shard['processed'] for shard in checkpoint.shards)
+    labeled = sum(shard['labeled'] for shard in checkpoint.shards)
+    failed = sum(shard.get('failed', 0) for shard in checkpoint.shards)
+    print(f"Backfill completato in {_format_eta(time.monotonic() - started)}: "
+          f"{processed} email elaborate, {labeled} etichettate, {failed} con errori.")
+    if failed:
+        print(f"Gli id delle email con errori sono in {args.checkpoint} (campo failed_messages di ogni shard)")
+    gmail_service.cascade_stats.report()
+    return 0
+
+def parse_args():
+    """Legge i comandi da riga di comando"""
+    parser = argparse.ArgumentParser(description="Organizza le email di Gmail con un modello Ollama")
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export', help="Esporta le email in uno snapshot JSONL (.jsonl o .jsonl.gz)")
+    export_parser.add_argument('snapshot', help="File di destinazione")
+    export_parser.add_argument('--max-emails', type=int, default=None, help="Numero massimo di email (predefinito: tutte)")
+    export_parser.add_argument('--query', default=None, help="Filtro di ricerca Gmail, es. 'after:2024/01/01'")
+
+    classify_parser = subparsers.add_parser('classify', help="Categorizza offline uno snapshot senza chiamate a Gmail")
+    classify_parser.add_argument('snapshot', help="Snapshot prodotto dal comando export")
+    classify_parser.add_argument('--output', default='results.jsonl', help="File JSONL con la categoria di ogni email")
+    classify_parser.add_argument('--baseline', default=None, help="Risultati di una classificazione precedente da confrontare")
+    classify_parser.add_argument('--workers', type=int, default=1,
+                                 help="Processi del pool; oltre 1 richiede OLLAMA_NUM_PARALLEL sul server")
+
+    backfill_parser = subparsers.add_parser('backfill', help="Organizza tutta la casella di posta, con ripresa automatica")
+    backfill_parser.add_argument('--since', default='2004-04-01', help="Data iniziale AAAA-MM-GG (predefinito: nascita di Gmail)")
+    backfill_parser.add_argument('--until', default=None, help="Data finale esclusa AAAA-MM-GG (predefinito: oggi)")
+    backfill_parser.add_argument('--shard-days', type=int, default=30, help="Giorni per shard")
+    backfill_parser.add_argument('--workers', type=int, default=2,
+                                 help="Shard elaborati in parallelo; oltre 1 richiede OLLAMA_NUM_PARALLEL sul server")
+    backfill_parser.add_argument('--checkpoint',
+                                 default=os.path.join(os.environ.get('TOKEN_DIR', '.'), 'backfill_checkpoint.json'),
+                                 help="File di checkpoint per riprendere un backfill interrotto")
+    backfill_parser.add_argument('--restart', action='store_true', help="Ignora il checkpoint esistente")
+
+    return parser.parse_args()
 
 def main():
     """Funzione principale dell'applicazione"""
+    args = parse_args()
+    if args.command == 'export':
+        return run_export(args)
+    if args.command == 'classify':
+        return run_classify(args)
+    if args.command == 'backfill':
+        return run_backfill(args)
+
     gmail_service = None
     try:
         print("\n🚀 Avvio Email Organizer IA v2.0")
@@ -576,20 +1631,25 @@ def main():
         logging.info(f"Impostazioni: {settings}")
         
         # Inizializza il servizio Gmail
-        gmail_service = GmailService()
+        gmail_service = GmailService(
+            pool_size=settings.get("http_pool_size", 10),
+            token_budget=settings.get("body_token_budget", DEFAULT_BODY_TOKEN_BUDGET),
+            rule_engine=build_rule_engine(config)
+        )
         service = gmail_service.get_service()
         
         # Ottieni le email
         max_emails = settings.get("max_emails_to_process", 50)
         check_body = settings.get("check_body", True)
-        body_length = settings.get("body_extract_length", 1000)
+        body_length = settings.get("body_extract_length", DEFAULT_BODY_EXTRACT_LENGTH)
         
         logging.info(f"Recupero delle ultime {max_emails} email...")
         emails = get_emails(service, max_results=max_emails, include_body=check_body, body_length=body_length)
         
         if emails:
             # Processa le email
-            process_emails(service, emails, config)
+            if not process_emails(service, emails, config, gmail_service):
+                return 1
         else:
             logging.info("Nessuna email da processare.")
 
@@ -597,9 +1657,9 @@ def main():
         logging.error(f"Errore durante l'esecuzione: {e}")
         return 1
     finally:
-        # Chiudi la connessione con il modello
-        if gmail_service and gmail_service.categorizer:
-            gmail_service.categorizer.close()
+        # Chiudi la connessione con il modello solo se è stato effettivamente avviato
+        if gmail_service and gmail_service._categorizer:
+            gmail_service._categorizer.close()
 
     return 0
 
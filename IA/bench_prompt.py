@@ -0,0 +1,72 @@
+"""
+Benchmark del preprocessing del corpo delle email.
+
+Per ogni email di uno snapshot (vedi `python Email_IA.py export`) confronta il prompt costruito
+con il vecchio troncamento a caratteri (body_extract_length) e con preprocess_body + budget di token:
+- token stimati del corpo;
+- token del prompt e tempo di prompt-eval misurati da Ollama (prompt_eval_count / prompt_eval_duration).
+
+Con --no-model vengono calcolate solo le stime, senza contattare Ollama.
+
+Uso: python bench_prompt.py snapshot.jsonl.gz [--limit 50] [--chars 1000] [--budget 160] [--no-model]
+"""
+import argparse
+import statistics
+
+from Email_IA import DEFAULT_BODY_TOKEN_BUDGET, LEGACY_BODY_LENGTH, AICategorizer, estimate_tokens, preprocess_body, read_snapshot
+
+
+def _prompt_eval(categorizer, email):
+    """Esegue solo la valutazione del prompt (un token generato) e restituisce (token, secondi)"""
+    import ollama
+
+    prompt = categorizer._create_categorization_prompt(email, [])
+    response = ollama.generate(model=categorizer.model_name, prompt=prompt, options={"num_predict": 1})
+    return response["prompt_eval_count"], response["prompt_eval_duration"] / 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del preprocessing del corpo delle email")
+    parser.add_argument("snapshot", help="Snapshot JSONL prodotto da 'Email_IA.py export'")
+    parser.add_argument("--limit", type=int, default=50, help="Numero di email da misurare")
+    parser.add_argument("--chars", type=int, default=LEGACY_BODY_LENGTH, help="Troncamento a caratteri di riferimento")
+    parser.add_argument("--budget", type=int, default=DEFAULT_BODY_TOKEN_BUDGET, help="Budget di token del preprocessing")
+    parser.add_argument("--no-model", action="store_true", help="Solo stime, senza Ollama")
+    args = parser.parse_args()
+
+    categorizer = None if args.no_model else AICategorizer(check_resources=False, token_budget=0, read_only=True)
+    results = {"caratteri": [], "preprocessing": []}
+
+    for i, email in enumerate(read_snapshot(args.snapshot)):
+        if i >= args.limit:
+            break
+        variants = {
+            "caratteri": dict(email, body=email["body"][:args.chars]),
+            "preprocessing": dict(email, body=preprocess_body(email["body"], args.budget)),
+        }
+        # Ordine alternato, così la cache dei prefissi di Ollama non favorisce una variante
+        order = list(variants) if i % 2 == 0 else list(reversed(list(variants)))
+        for name in order:
+            sample = {"stimati": estimate_tokens(variants[name]["body"])}
+            if categorizer:
+                sample["prompt"], sample["secondi"] = _prompt_eval(categorizer, variants[name])
+            results[name].append(sample)
+
+    if not results["caratteri"]:
+        print("Nessuna email nello snapshot")
+        return
+
+    print(f"Email misurate: {len(results['caratteri'])}")
+    labels = {"stimati": "token corpo (stima)", "prompt": "token prompt", "secondi": "prompt-eval (s)"}
+    for metric, label in labels.items():
+        if metric not in results["caratteri"][0]:
+            continue
+        old = [sample[metric] for sample in results["caratteri"]]
+        new = [sample[metric] for sample in results["preprocessing"]]
+        saved = 1 - sum(new) / sum(old) if sum(old) else 0
+        print(f"{label:<20} caratteri: media {statistics.mean(old):9.2f}   "
+              f"preprocessing: media {statistics.mean(new):9.2f}   risparmio {saved:6.1%}")
+
+
+if __name__ == "__main__":
+    main()
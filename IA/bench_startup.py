@@ -0,0 +1,99 @@
+"""
+Benchmark dell'avvio di Email_IA.py.
+
+Misura, in processi Python nuovi (avvio a freddo):
+- il tempo di import di Email_IA e delle dipendenze pesanti che ora vengono caricate solo quando servono;
+- il tempo per creare una volta il client Gmail con build() e con build_gmail_service().
+
+Da google-api-python-client 2.0 build() usa già il documento di discovery statico incluso
+nella libreria: la creazione del client costa circa lo stesso nei due casi, e il guadagno
+sull'avvio viene solo dagli import rimandati.
+
+Non effettua richieste di rete né contatta Ollama.
+
+Uso: python bench_startup.py [--runs 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_CASES = {
+    "Email_IA": "import Email_IA",
+    "ollama": "import ollama",
+    "psutil": "import psutil",
+    "tqdm": "import tqdm",
+    "googleapiclient.discovery": "import googleapiclient.discovery",
+}
+
+# Credenziali fittizie: bastano per costruire il client, nessuna richiesta viene eseguita
+CREDENTIALS = "from google.oauth2.credentials import Credentials; creds = Credentials(token='bench')"
+
+# Librerie importate da entrambe le varianti, escluse dalla misura della creazione del client
+CLIENT_IMPORTS = "import googleapiclient.discovery, google.auth.transport.requests, httplib2"
+
+# Un'esecuzione reale crea il client una sola volta
+BUILD_CASES = {
+    "build()": (
+        "from googleapiclient.discovery import build",
+        "build('gmail', 'v1', credentials=creds)",
+    ),
+    "build_gmail_service()": (
+        "from Email_IA import build_gmail_service",
+        "build_gmail_service(creds)",
+    ),
+}
+
+
+def _run_timed(setup, statement):
+    """Esegue setup + statement in un nuovo interprete e restituisce i secondi impiegati da statement"""
+    code = (
+        f"{setup}\n"
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _report(label, samples):
+    if not samples:
+        print(f"{label:<30} non disponibile")
+        return
+    print(f"{label:<30} mediana {statistics.median(samples) * 1000:8.1f} ms   "
+          f"min {min(samples) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dell'avvio di Email_IA.py")
+    parser.add_argument("--runs", type=int, default=5, help="Ripetizioni per ogni misura")
+    args = parser.parse_args()
+
+    print("--- Tempo di import (processo nuovo) ---")
+    for label, statement in IMPORT_CASES.items():
+        samples = [_run_timed("", statement) for _ in range(args.runs)]
+        _report(label, [s for s in samples if s is not None])
+
+    print("\n--- Creazione del client Gmail (processo nuovo, import esclusi) ---")
+    for label, (imports, statement) in BUILD_CASES.items():
+        samples = [_run_timed(f"{CREDENTIALS}\n{CLIENT_IMPORTS}\n{imports}", statement)
+                   for _ in range(args.runs)]
+        _report(label, [s for s in samples if s is not None])
+
+    print("\n--- Avvio a freddo completo: import + client Gmail ---")
+    cold_start = "import Email_IA\nEmail_IA.build_gmail_service(creds)"
+    samples = [_run_timed(CREDENTIALS, cold_start) for _ in range(args.runs)]
+    _report("Email_IA", [s for s in samples if s is not None])
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,23 @@ import os
 import json
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import Request, AuthorizedSession
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import httplib2
+import requests
+import socket
+import threading
 from email.mime.text import MIMEText
 import base64
 import re
-from datetime import datetime
+import gzip
+import time
+import tempfile
+import argparse
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 # Se modifichi questi scope, elimina il file token.pickle
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -31,7 +42,9 @@ def load_config():
             "settings": {
                 "max_emails_to_process": 50,
                 "check_body": True,
-                "body_extract_length": 1000
+                "body_extract_length": 1000,
+                "http_pool_size": 10,
+                "quota_units_per_second": 200
             }
         }
     except json.JSONDecodeError:
@@ -41,11 +54,57 @@ def load_config():
             "settings": {
                 "max_emails_to_process": 50,
                 "check_body": True,
-                "body_extract_length": 1000
+                "body_extract_length": 1000,
+                "http_pool_size": 10,
+                "quota_units_per_second": 200
             }
         }
 
-def get_gmail_service():
+# PooledHttp, iter_emails/export_snapshot e il backfill sono copie ridotte di quelli in
+# IA/Email_IA.py, dove si trovano spiegazioni e motivazioni: le due versioni sono distribuite
+# separatamente, quindi ogni correzione va fatta lì e riportata qui.
+
+class PooledHttp:
+    """Trasporto HTTP thread-safe per googleapiclient (vedi IA/Email_IA.py)"""
+
+    def __init__(self, credentials, pool_size=10, timeout=60):
+        self.credentials = credentials
+        self.timeout = timeout
+        self._refresh_lock = threading.Lock()
+        self._session = AuthorizedSession(credentials, refresh_status_codes=())
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def _ensure_valid_credentials(self, rejected_token=None):
+        if self.credentials.valid and self.credentials.token != rejected_token:
+            return
+        with self._refresh_lock:
+            if not self.credentials.valid or self.credentials.token == rejected_token:
+                self.credentials.refresh(Request())
+
+    def _send(self, method, uri, body, headers):
+        try:
+            return self._session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise socket.timeout(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(str(e)) from e
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        self._ensure_valid_credentials()
+        token = self.credentials.token
+        response = self._send(method, uri, body, headers)
+        if response.status_code == 401:
+            self._ensure_valid_credentials(rejected_token=token)
+            response = self._send(method, uri, body, headers)
+        info = {key.lower(): value for key, value in response.headers.items()
+                if key.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+    def close(self):
+        self._session.close()
+
+def get_gmail_service(pool_size=10):
     """Crea e restituisce il servizio Gmail autenticato"""
     creds = None
     # Il file token.pickle memorizza i token di accesso e refresh dell'utente
@@ -74,7 +133,37 @@ def get_gmail_service():
         with open(TOKEN_PATH, 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('gmail', 'v1', credentials=creds)
+    # Il trasporto condiviso permette di usare lo stesso servizio da più thread
+    return build('gmail', 'v1', http=PooledHttp(creds, pool_size=pool_size))
+
+def parse_message(msg, include_body=True, body_length=1000):
+    """Estrae id, intestazioni e corpo da un messaggio Gmail"""
+    headers = msg['payload']['headers']
+    subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'Nessun oggetto')
+    sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Mittente sconosciuto')
+    date_str = next((header['value'] for header in headers if header['name'] == 'Date'), '')
+
+    # Estrai il corpo dell'email solo se richiesto
+    body = ""
+    if include_body:
+        if 'parts' in msg['payload']:
+            for part in msg['payload']['parts']:
+                if part['mimeType'] == 'text/plain' and 'data' in part['body']:
+                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
+                    break
+        elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
+            body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8', errors='ignore')
+
+        # Limita la lunghezza del corpo
+        body = body[:body_length] if body else ""
+
+    return {
+        'id': msg['id'],
+        'subject': subject,
+        'sender': sender,
+        'date': date_str,
+        'body': body
+    }
 
 def get_emails(service, max_results=50, include_body=True, body_length=1000):
     """Ottiene le email dalla casella di posta"""
@@ -93,74 +182,126 @@ def get_emails(service, max_results=50, include_body=True, body_length=1000):
             print(f"Elaborate {i}/{len(messages)} email...")
         
         msg = service.users().messages().get(userId='me', id=message['id']).execute()
-        headers = msg['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'Nessun oggetto')
-        sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Mittente sconosciuto')
-        date_str = next((header['value'] for header in headers if header['name'] == 'Date'), '')
-        
-        # Estrai il corpo dell'email solo se richiesto
-        body = ""
-        if include_body:
-            if 'parts' in msg['payload']:
-                for part in msg['payload']['parts']:
-                    if part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                        body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-                        break
-            elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                body = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8', errors='ignore')
-            
-            # Limita la lunghezza del corpo
-            body = body[:body_length] if body else ""
-        
-        emails.append({
-            'id': message['id'],
-            'subject': subject,
-            'sender': sender,
-            'date': date_str,
-            'body': body
-        })
+        emails.append(parse_message(msg, include_body, body_length))
     
     return emails
 
+def iter_emails(service, max_results=None, include_body=True, body_length=1000, query=None, limiter=None):
+    """Scorre tutte le pagine della casella di posta restituendo un'email alla volta"""
+    page_token = None
+    fetched = 0
+    while True:
+        page_size = 500 if max_results is None else min(500, max_results - fetched)
+        if page_size <= 0:
+            return
+        if limiter:
+            limiter.acquire(QUOTA_COST['messages.list'])
+        results = service.users().messages().list(
+            userId='me', maxResults=page_size, pageToken=page_token, q=query
+        ).execute(num_retries=5)
+        for message in results.get('messages', []):
+            if limiter:
+                limiter.acquire(QUOTA_COST['messages.get'])
+            try:
+                msg = service.users().messages().get(userId='me', id=message['id']).execute(num_retries=5)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                print(f"Email {message['id']} non più disponibile, saltata")
+                continue
+            fetched += 1
+            yield parse_message(msg, include_body, body_length)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def _open_snapshot(path, mode):
+    """Apre un file snapshot, compresso con gzip se termina in .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def export_snapshot(emails, path):
+    """Scrive le email in uno snapshot JSONL (una email per riga) e restituisce il numero di righe"""
+    count = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.snapshot',
+                                    suffix='.jsonl.gz' if path.endswith('.gz') else '.jsonl')
+    os.close(fd)
+    try:
+        with _open_snapshot(tmp_path, 'w') as f:
+            for email in emails:
+                f.write(json.dumps(email, ensure_ascii=False) + '\n')
+                count += 1
+                if count % 1000 == 0:
+                    print(f"Esportate {count} email...")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return count
+
+def read_snapshot(path):
+    """Legge uno snapshot JSONL restituendo un'email alla volta"""
+    with _open_snapshot(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def compile_rules(rules):
+    """Compila le regole in un'unica espressione regolare per etichetta, mantenendo l'ordine"""
+    compiled = []
+    for label, keywords in rules.items():
+        if not keywords:
+            continue
+        # Le parole chiave più lunghe per prime, così l'alternanza trova la corrispondenza più specifica
+        alternatives = sorted({keyword.lower() for keyword in keywords}, key=len, reverse=True)
+        compiled.append((label, re.compile('|'.join(re.escape(k) for k in alternatives))))
+    return compiled
+
+def classify_email(email, compiled_rules):
+    """Restituisce la prima etichetta le cui parole chiave compaiono nell'email, altrimenti None"""
+    content_to_check = (email['subject'] + ' ' + email['sender'] + ' ' + email['body']).lower()
+    for label, pattern in compiled_rules:
+        if pattern.search(content_to_check):
+            return label
+    return None
+
+class LabelCache:
+    """Id delle etichette Gmail per nome: letti una volta e condivisi tra i thread"""
+
+    def __init__(self, service):
+        self.service = service
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def get_id(self, name):
+        """Restituisce l'id dell'etichetta, creandola se non esiste"""
+        with self._lock:
+            if self._ids is None:
+                labels_response = self.service.users().labels().list(userId='me').execute()
+                self._ids = {label['name']: label['id'] for label in labels_response.get('labels', [])}
+            if name not in self._ids:
+                created_label = self.service.users().labels().create(
+                    userId='me',
+                    body={'name': name}
+                ).execute()
+                self._ids[name] = created_label['id']
+            return self._ids[name]
+
 def organize_emails(service, emails, rules):
     """Organizza le email in base alle regole definite"""
     if not rules:
         print("Nessuna regola definita per la categorizzazione.")
         return 0
 
+    compiled_rules = compile_rules(rules)
+    labels = LabelCache(service)
     organized_count = 0
     for email in emails:
-        subject = email['subject'].lower()
-        sender = email['sender'].lower()
-        body = email['body'].lower()
-        content_to_check = subject + ' ' + sender + ' ' + body
-        assigned_label = None
-
-        # Applica le regole
-        for label, keywords in rules.items():
-            if any(keyword.lower() in content_to_check for keyword in keywords):
-                assigned_label = label
-                break
+        assigned_label = classify_email(email, compiled_rules)
 
         if assigned_label:
-            # Ottieni tutte le etichette esistenti
-            labels_response = service.users().labels().list(userId='me').execute()
-            labels = labels_response.get('labels', [])
-            
-            # Cerca l'ID dell'etichetta se esiste già
-            label_id = None
-            for label_obj in labels:
-                if label_obj['name'] == assigned_label:
-                    label_id = label_obj['id']
-                    break
-            
-            # Crea l'etichetta se non esiste
-            if not label_id:
-                created_label = service.users().labels().create(
-                    userId='me',
-                    body={'name': assigned_label}
-                ).execute()
-                label_id = created_label['id']
+            label_id = labels.get_id(assigned_label)
 
             # Applica l'etichetta all'email
             service.users().messages().modify(
@@ -180,7 +321,304 @@ def print_stats(emails, organized):
     print(f"Email categorizzate: {organized}")
     print(f"Percentuale di successo: {(organized/len(emails)*100) if emails else 0:.1f}%")
 
+# Regole compilate nei processi del pool di classificazione offline
+_worker_rules = None
+
+def _init_classify_worker(baseline_rules, candidate_rules):
+    """Compila le regole una sola volta per processo del pool"""
+    global _worker_rules
+    _worker_rules = (compile_rules(baseline_rules), compile_rules(candidate_rules))
+
+def _classify_worker(email):
+    """Classifica un'email con le regole attuali e con quelle candidate"""
+    baseline_rules, candidate_rules = _worker_rules
+    return email, classify_email(email, baseline_rules), classify_email(email, candidate_rules)
+
+def classify_snapshot(snapshot_path, baseline_rules, candidate_rules, output_path, workers=None):
+    """Riclassifica offline uno snapshot e scrive le email la cui categoria cambia"""
+    total = 0
+    changes = {}
+    with Pool(processes=workers, initializer=_init_classify_worker,
+              initargs=(baseline_rules, candidate_rules)) as pool, \
+            _open_snapshot(output_path, 'w') as out:
+        results = pool.imap(_classify_worker, read_snapshot(snapshot_path), chunksize=256)
+        for email, before, after in results:
+            total += 1
+            if before == after:
+                continue
+            changes[(before, after)] = changes.get((before, after), 0) + 1
+            out.write(json.dumps({
+                'id': email['id'],
+                'subject': email['subject'],
+                'sender': email['sender'],
+                'before': before,
+                'after': after
+            }, ensure_ascii=False) + '\n')
+    return total, changes
+
+def run_export(args):
+    """Esporta la casella di posta in uno snapshot locale"""
+    settings = load_config().get("settings", {})
+    service = get_gmail_service(settings.get("http_pool_size", 10))
+    emails = iter_emails(
+        service,
+        max_results=args.max_emails,
+        include_body=settings.get("check_body", True),
+        body_length=settings.get("body_extract_length", 1000),
+        query=args.query,
+        limiter=QuotaLimiter(settings.get("quota_units_per_second", 200))
+    )
+    count = export_snapshot(emails, args.snapshot)
+    print(f"Snapshot completato: {count} email salvate in {args.snapshot}")
+
+def run_classify(args):
+    """Confronta offline le regole attuali con quelle di un altro file di configurazione"""
+    baseline_rules = load_config().get("rules", {})
+    with open(args.rules, 'r', encoding='utf-8') as f:
+        candidate_rules = json.load(f).get("rules", {})
+
+    total, changes = classify_snapshot(args.snapshot, baseline_rules, candidate_rules, args.output, args.workers)
+    changed = sum(changes.values())
+
+    print("\n--- Differenze di categorizzazione ---")
+    print(f"Email analizzate: {total}")
+    print(f"Email con categoria diversa: {changed}")
+    for (before, after), count in sorted(changes.items(), key=lambda item: -item[1]):
+        print(f"  {before or 'Nessuna'} -> {after or 'Nessuna'}: {count}")
+    print(f"Dettaglio salvato in {args.output}")
+
+# Backfill: copia ridotta di IA/Email_IA.py
+QUOTA_COST = {'messages.list': 5, 'messages.get': 5, 'messages.modify': 5}
+
+class QuotaLimiter:
+    """Token bucket thread-safe sulle unità di quota Gmail al secondo"""
+
+    def __init__(self, units_per_second=200):
+        self.units_per_second = units_per_second
+        self._available = units_per_second
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available = min(self.units_per_second,
+                                      self._available + (now - self._last) * self.units_per_second)
+                self._last = now
+                if self._available >= units:
+                    self._available -= units
+                    return
+                wait = (units - self._available) / self.units_per_second
+            time.sleep(wait)
+
+def make_shards(since, until, shard_days=30):
+    """Divide l'intervallo [since, until) in shard di date, dal più recente al più vecchio"""
+    shards = []
+    end = until
+    while end > since:
+        start = max(since, end - timedelta(days=shard_days))
+        shards.append({'after': int(start.timestamp()), 'before': int(end.timestamp()),
+                       'page_token': None, 'last_message': None, 'processed': 0, 'labeled': 0,
+                       'failed': 0, 'failed_messages': [], 'estimate': None, 'done': False})
+        end = start
+    return shards
+
+class BackfillCheckpoint:
+    """Avanzamento del backfill su disco, scritto in modo atomico al più una volta al secondo"""
+
+    def __init__(self, path, shards):
+        self.path = path
+        self.shards = shards
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(path, json.load(f)['shards'])
+
+    def update(self, index, force=False, **fields):
+        with self._lock:
+            self.shards[index].update(fields)
+            if force or time.monotonic() - self._last_save >= 1:
+                self._save()
+
+    def _save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.backfill', suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'shards': self.shards, 'updated_at': datetime.now().isoformat()}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+def _format_eta(seconds):
+    return str(timedelta(seconds=int(seconds))) if seconds is not None else '?'
+
+def _report_shard(shard, processed_now, started):
+    elapsed = time.monotonic() - started
+    rate = processed_now / elapsed if elapsed > 0 else 0
+    estimate = shard['estimate'] or 0
+    eta = max(estimate - shard['processed'], 0) / rate if rate else None
+    name = ' → '.join(datetime.fromtimestamp(shard[key]).strftime('%Y-%m-%d') for key in ('after', 'before'))
+    state = "completato" if shard['done'] else f"ETA {_format_eta(eta)}"
+    print(f"[{name}] {shard['processed']}/~{estimate} email, {shard['labeled']} etichettate, "
+          f"{shard.get('failed', 0)} con errori, {rate:.1f} email/s, {state}")
+
+def backfill_shard(service, checkpoint, index, limiter, handle_message, stop_event):
+    """Elabora tutte le email di uno shard riprendendo dal checkpoint"""
+    shard = checkpoint.shards[index]
+    if shard['done'] or stop_event.is_set():
+        return
+    query = f"after:{shard['after']} before:{shard['before']}"
+    page_token = shard['page_token']
+    skip_until = shard['last_message']
+    started = time.monotonic()
+    processed_now = 0
+
+    while True:
+        limiter.acquire(QUOTA_COST['messages.list'])
+        results = service.users().messages().list(
+            userId='me', q=query, maxResults=500, pageToken=page_token
+        ).execute(num_retries=5)
+        if shard['estimate'] is None:
+            checkpoint.update(index, estimate=results.get('resultSizeEstimate', 0))
+
+        messages = results.get('messages', [])
+        ids = [message['id'] for message in messages]
+        if skip_until in ids:
+            messages = messages[ids.index(skip_until) + 1:]
+        skip_until = None
+
+        for message in messages:
+            if stop_event.is_set():
+                return
+            fields = {'last_message': message['id'], 'processed': shard['processed'] + 1}
+            try:
+                limiter.acquire(QUOTA_COST['messages.get'])
+                msg = service.users().messages().get(userId='me', id=message['id']).execute(num_retries=5)
+                fields['labeled'] = shard['labeled'] + (1 if handle_message(msg) else 0)
+            except Exception as e:
+                print(f"Errore nell'elaborazione dell'email {message['id']}: {e}")
+                fields['failed'] = shard.get('failed', 0) + 1
+                fields['failed_messages'] = shard.get('failed_messages', []) + [message['id']]
+            processed_now += 1
+            checkpoint.update(index, **fields)
+            if processed_now % 200 == 0:
+                _report_shard(shard, processed_now, started)
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+        checkpoint.update(index, force=True, page_token=page_token, last_message=None)
+
+    checkpoint.update(index, force=True, done=True, page_token=None, last_message=None)
+    _report_shard(shard, processed_now, started)
+
+def run_backfill(args):
+    """Organizza l'intera casella di posta per intervalli di date, con ripresa da checkpoint"""
+    config = load_config()
+    settings = config.get("settings", {})
+    compiled_rules = compile_rules(config.get("rules", {}))
+    if not compiled_rules:
+        print("Nessuna regola definita per la categorizzazione.")
+        return
+
+    checkpoint = None if args.restart else BackfillCheckpoint.load(args.checkpoint)
+    if checkpoint:
+        print(f"Ripresa del backfill da {args.checkpoint}")
+    else:
+        since = datetime.strptime(args.since, '%Y-%m-%d')
+        until = datetime.strptime(args.until, '%Y-%m-%d') if args.until else datetime.now() + timedelta(days=1)
+        checkpoint = BackfillCheckpoint(args.checkpoint, make_shards(since, until, args.shard_days))
+        checkpoint.save()
+
+    pending = [i for i, shard in enumerate(checkpoint.shards) if not shard['done']]
+    print(f"Shard da elaborare: {len(pending)}/{len(checkpoint.shards)}")
+
+    service = get_gmail_service(max(settings.get("http_pool_size", 10), args.workers))
+    limiter = QuotaLimiter(settings.get("quota_units_per_second", 200))
+    labels = LabelCache(service)
+    include_body = settings.get("check_body", True)
+    body_length = settings.get("body_extract_length", 1000)
+
+    def handle_message(msg):
+        email = parse_message(msg, include_body, body_length)
+        assigned_label = classify_email(email, compiled_rules)
+        if assigned_label:
+            limiter.acquire(QUOTA_COST['messages.modify'])
+            service.users().messages().modify(
+                userId='me',
+                id=msg['id'],
+                body={'addLabelIds': [labels.get_id(assigned_label)]}
+            ).execute(num_retries=5)
+        return assigned_label
+
+    started = time.monotonic()
+    stop_event = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(backfill_shard, service, checkpoint, i, limiter, handle_message, stop_event)
+                       for i in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Interruzione (anche Ctrl+C): i thread si fermano al messaggio corrente
+                stop_event.set()
+                raise
+    finally:
+        checkpoint.save()
+
+    processed = sum(shard['processed'] for shard in checkpoint.shards)
+    labeled = sum(shard['labeled'] for shard in checkpoint.shards)
+    failed = sum(shard.get('failed', 0) for shard in checkpoint.shards)
+    print(f"Backfill completato in {_format_eta(time.monotonic() - started)}: "
+          f"{processed} email elaborate, {labeled} etichettate, {failed} con errori.")
+    if failed:
+        print(f"Gli id delle email con errori sono in {args.checkpoint} (campo failed_messages di ogni shard)")
+
+def parse_args():
+    """Legge i comandi da riga di comando"""
+    parser = argparse.ArgumentParser(description="Organizza le email di Gmail con regole a parole chiave")
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export', help="Esporta le email in uno snapshot JSONL (.jsonl o .jsonl.gz)")
+    export_parser.add_argument('snapshot', help="File di destinazione")
+    export_parser.add_argument('--max-emails', type=int, default=None, help="Numero massimo di email (predefinito: tutte)")
+    export_parser.add_argument('--query', default=None, help="Filtro di ricerca Gmail, es. 'after:2024/01/01'")
+
+    classify_parser = subparsers.add_parser('classify', help="Riclassifica offline uno snapshot senza chiamate a Gmail")
+    classify_parser.add_argument('snapshot', help="Snapshot prodotto dal comando export")
+    classify_parser.add_argument('--rules', required=True, help="config.json con le regole da confrontare con quelle attuali")
+    classify_parser.add_argument('--output', default='diff.jsonl', help="File JSONL con le email che cambiano categoria")
+    classify_parser.add_argument('--workers', type=int, default=None, help="Processi del pool (predefinito: numero di CPU)")
+
+    backfill_parser = subparsers.add_parser('backfill', help="Organizza tutta la casella di posta, con ripresa automatica")
+    backfill_parser.add_argument('--since', default='2004-04-01', help="Data iniziale AAAA-MM-GG (predefinito: nascita di Gmail)")
+    backfill_parser.add_argument('--until', default=None, help="Data finale esclusa AAAA-MM-GG (predefinito: oggi)")
+    backfill_parser.add_argument('--shard-days', type=int, default=30, help="Giorni per shard")
+    backfill_parser.add_argument('--workers', type=int, default=4, help="Shard elaborati in parallelo")
+    backfill_parser.add_argument('--checkpoint', default=os.path.join(TOKEN_DIR, 'backfill_checkpoint.json'),
+                                 help="File di checkpoint per riprendere un backfill interrotto")
+    backfill_parser.add_argument('--restart', action='store_true', help="Ignora il checkpoint esistente")
+
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if args.command == 'export':
+        return run_export(args)
+    if args.command == 'classify':
+        return run_classify(args)
+    if args.command == 'backfill':
+        return run_backfill(args)
+
     # Carica la configurazione
     config = load_config()
     settings = config.get("settings", {})
@@ -195,7 +633,7 @@ def main():
     print(f"Categorie configurate: {', '.join(rules.keys())}")
     
     # Ottieni il servizio Gmail
-    service = get_gmail_service()
+    service = get_gmail_service(settings.get("http_pool_size", 10))
     
     # Ottieni le email
     print(f"Recupero delle ultime {max_emails} email...")